@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: us-ascii -*-
 
+import _thread
+import bisect
+import codecs
+
 
 class SCSU:
 
@@ -68,6 +72,10 @@ class SCSU:
     MODE_SINGLE_BYTE = 1
     MODE_UNICODE = 2
 
+    FORMAT_SCSU = 0x01
+    FORMAT_UTF8 = 0x02
+    FORMAT_UTF16BE = 0x03
+
     SPECIAL_WINDOW_POSITIONS = {
         0xF9: 0x00C0,
         0xFA: 0x0250,
@@ -87,6 +95,39 @@ class SCSU:
     default_dynamic_window_key = 0x01
     default_dynamic_window_position = 0x0080
 
+    # Lookup tables built the first time they are needed, so that importing the module stays cheap.
+    reserved_octet_table = None
+    window_position_table = None
+
+    @staticmethod
+    def get_reserved_octet_table() -> tuple:
+        """
+        Get a table of which octets need to be preceded with an SQ0 octet when used in single-byte mode. The table is
+        built on first use and shared by every instance.
+
+        :rtype: tuple
+        :return: A tuple of 256 booleans, indexed by octet.
+        """
+        if SCSU.reserved_octet_table is None:
+            reserved_octets = set(SCSU.TAG_SQn + SCSU.TAG_SCn + SCSU.TAG_SDn)
+            reserved_octets.update((SCSU.TAG_SDX, SCSU.TAG_SRX, SCSU.TAG_SQU, SCSU.TAG_SCU))
+            SCSU.reserved_octet_table = tuple(octet in reserved_octets for octet in range(256))
+        return SCSU.reserved_octet_table
+
+    @staticmethod
+    def get_window_position_table() -> tuple:
+        """
+        Get a table of the window position for each window key. The table is built on first use and shared by every
+        instance.
+
+        :rtype: tuple
+        :return: A tuple of 256 Unicode codepoints, or None for reserved window keys, indexed by window key.
+        """
+        if SCSU.window_position_table is None:
+            SCSU.window_position_table = tuple(SCSU.get_window_position_for_window_key(window_key)
+                                               for window_key in range(256))
+        return SCSU.window_position_table
+
     @staticmethod
     def codepoint_is_ascii(codepoint: int) -> bool:
         """
@@ -109,8 +150,7 @@ class SCSU:
         :rtype: bool
         :return: True if the given octet requires escaping; false otherwise.
         """
-        return (octet in SCSU.TAG_SQn) or octet == SCSU.TAG_SDX or octet == SCSU.TAG_SRX or octet == SCSU.TAG_SQU \
-            or octet == SCSU.TAG_SCU or (octet in SCSU.TAG_SCn) or (octet in SCSU.TAG_SDn)
+        return SCSU.get_reserved_octet_table()[octet]
 
     @staticmethod
     def encode_codepoint_as_utf16be_array(codepoint: int) -> list:
@@ -161,6 +201,59 @@ class SCSU:
         """
         return codepoint <= 0xFFFF
 
+    @staticmethod
+    def get_utf16_length(unicode_string: str) -> int:
+        """
+        Compute the length of a Unicode string encoded as UTF-16 without encoding it.
+
+        :type unicode_string: str
+        :param unicode_string: The Unicode string.
+        :rtype: int
+        :return: The number of octets in the UTF-16 encoding.
+        """
+
+        # Every character takes two octets, except supplementary characters, which take four.
+        if not unicode_string or max(unicode_string) <= '\uFFFF':
+            return len(unicode_string) * 2
+
+        return (len(unicode_string) + sum(1 for character in unicode_string if character > '\uFFFF')) * 2
+
+    @staticmethod
+    def get_scsu_length_lower_bound(unicode_string: str) -> int:
+        """
+        Compute a lower bound for the length of a Unicode string encoded as SCSU without encoding it.
+
+        :type unicode_string: str
+        :param unicode_string: The Unicode string.
+        :rtype: int
+        :return: The fewest octets the SCSU encoding can take.
+        """
+
+        # Every character takes at least one octet.
+        if unicode_string.isascii():
+            return len(unicode_string)
+
+        # Find the 32-character blocks covered by the default dynamic windows, which all start on a block boundary.
+        default_dynamic_window_blocks = {(window_position >> 5) + block_index
+                                         for window_position in SCSU.default_dynamic_window_positions
+                                         for block_index in range(4)}
+
+        # Count the characters that can't be put in a window, and the other non-ASCII characters outside the default
+        # dynamic windows.
+        incompressible_count = 0
+        windowless_count = 0
+        for character in unicode_string:
+            codepoint = ord(character)
+            if 0x3400 <= codepoint < 0xE000:
+                incompressible_count += 1
+            elif codepoint >= 0x80 and (codepoint >> 5) not in default_dynamic_window_blocks:
+                windowless_count += 1
+
+        # A character that can't be put in a window takes two octets in Unicode mode, which takes an SCU tag to enter,
+        # or three octets when quoted with an SQU tag. Any other character outside the default dynamic windows takes at
+        # least two octets on its own, unless a window is defined for it, which takes at least two octets.
+        return len(unicode_string) + incompressible_count + min(incompressible_count, 1) + min(windowless_count, 2)
+
     @staticmethod
     def codepoint_fits_in_window(codepoint: int, window_position: int) -> bool:
         """
@@ -250,8 +343,8 @@ class SCSU:
 
         # Iterate through each special window position and check if the special window position matches the given
         # window position.
-        special_window_key = next((index for index, special_window_position
-                                   in enumerate(SCSU.SPECIAL_WINDOW_POSITIONS)
+        special_window_key = next((window_key for window_key, special_window_position
+                                   in SCSU.SPECIAL_WINDOW_POSITIONS.items()
                                    if special_window_position == window_position), None)
 
         # If the window position matches a special window position, return that.
@@ -268,6 +361,45 @@ class SCSU:
             window_key = (window_position - 0xAC00) >> 7
             return window_key
 
+    @staticmethod
+    def get_window_position_for_window_key(window_key: int) -> int:
+        """
+        Compute the window position for a given window key.
+
+        :type window_key: int
+        :param window_key: The octet for selecting a window position.
+        :rtype: int
+        :return: The Unicode codepoint for the window position, or None if the window key is reserved.
+        """
+
+        # Is the window key for a special window position?
+        if window_key in SCSU.SPECIAL_WINDOW_POSITIONS:
+            return SCSU.SPECIAL_WINDOW_POSITIONS[window_key]
+
+        # Is the window key for a window position before the end of the CJK Compatibility block?
+        if 0x01 <= window_key <= 0x67:
+            return window_key << 7
+
+        # Is the window key for a window position in or after the Private Use Area?
+        if 0x68 <= window_key <= 0xA7:
+            return (window_key << 7) + 0xAC00
+
+    @staticmethod
+    def decode_supplementary_codepoint_window_base(hbyte: int, lbyte: int) -> tuple:
+        """
+        Decode the two octets following an SDX or UDX tag into a dynamic window index and a supplementary window
+        position.
+
+        :type hbyte: int
+        :param hbyte: The high octet.
+        :type lbyte: int
+        :param lbyte: The low octet.
+        :rtype: tuple
+        :return: A tuple containing the dynamic window index and the Unicode codepoint for the window position.
+        """
+        codepoint_window_base = (hbyte << 8) | lbyte
+        return codepoint_window_base >> 13, ((codepoint_window_base & 0x1FFF) << 7) + 0x10000
+
     @staticmethod
     def find_window_position_for_codepoint(codepoint: int) -> int:
         """
@@ -285,8 +417,8 @@ class SCSU:
             return 0
 
         # Iterate through each special window position and check if the codepoint fits in any of those windows.
-        special_window_position = next((window_position for index, window_position
-                                        in enumerate(SCSU.SPECIAL_WINDOW_POSITIONS)
+        special_window_position = next((window_position for window_key, window_position
+                                        in SCSU.SPECIAL_WINDOW_POSITIONS.items()
                                         if SCSU.codepoint_fits_in_window(codepoint, window_position)), None)
 
         # If we found a special window position, return that.
@@ -328,10 +460,23 @@ class SCSUEncoder(SCSU):
 
     used_dynamic_window_index_list = None
 
-    def __init__(self):
+    pending_window_definitions = None
+    half_block_occurrences = None
+    prefetched_character_offset = None
+
+    lookahead = None
+    planned_modes = None
+    planned_modes_start_index = None
+
+    def __init__(self, lookahead: int = None):
         """
         Instantiate a SCSU encoder object.
+
+        :type lookahead: int
+        :param lookahead: The number of characters to look ahead when deciding whether to switch modes, or None to only
+                          look at the next character.
         """
+        self.lookahead = lookahead
 
         self.reset()
 
@@ -349,6 +494,10 @@ class SCSUEncoder(SCSU):
 
         self.used_dynamic_window_index_list = list(range(8))
 
+        self.pending_window_definitions = []
+        self.half_block_occurrences = None
+        self.prefetched_character_offset = None
+
     def codepoint_fits_in_current_dynamic_window(self, codepoint: int) -> bool:
         """
         Determine if a given codepoint fits in the current dynamic window.
@@ -397,15 +546,51 @@ class SCSUEncoder(SCSU):
         assert self.codepoint_fits_in_current_dynamic_window(codepoint)
         return (codepoint - self.current_dynamic_window_position) + 128
 
-    def get_unused_dynamic_window_index(self) -> int:
+    def get_unused_dynamic_window_index(self, current_index: int = None) -> int:
         """
         Get an unused, or rarely used, dynamic window index.
 
+        :type current_index: int
+        :param current_index: The index of the character being encoded, if known.
         :rtype: int
         :return: A dynamic window index.
         """
+
+        # Did prefetch_windows record where each half-block is used? If so, pick the dynamic window that will be needed
+        # again furthest in the future, and the least recently used of those.
+        if self.half_block_occurrences is not None and current_index is not None:
+            character_index = self.prefetched_character_offset + current_index
+            return max(reversed(self.used_dynamic_window_index_list),
+                       key=lambda dynamic_window_index:
+                       self.find_next_use_of_window(self.dynamic_window_positions[dynamic_window_index],
+                                                    character_index))
+
         return self.used_dynamic_window_index_list[-1]
 
+    def find_next_use_of_window(self, window_position: int, character_index: int) -> float:
+        """
+        Find the next character after a given character that falls in a window, using the half-block occurrences
+        recorded by prefetch_windows.
+
+        :type window_position: int
+        :param window_position: The Unicode codepoint for the window position.
+        :type character_index: int
+        :param character_index: The index of the character to search after.
+        :rtype: float
+        :return: The index of the next character in the window, or infinity if there is none.
+        """
+        next_use = float('inf')
+
+        # A window covers one half-block, or parts of two if it isn't aligned.
+        for half_block in {window_position >> 7, (window_position + 127) >> 7}:
+            occurrences = self.half_block_occurrences.get(half_block)
+            if occurrences:
+                occurrence_index = bisect.bisect_right(occurrences, character_index)
+                if occurrence_index < len(occurrences):
+                    next_use = min(next_use, occurrences[occurrence_index])
+
+        return next_use
+
     def move_dynamic_window_index_to_front(self, dynamic_window_index: int):
         """
         Move a dynamic window index to the front of the dynamic window index list.
@@ -419,6 +604,219 @@ class SCSUEncoder(SCSU):
             self.used_dynamic_window_index_list.remove(dynamic_window_index)
             self.used_dynamic_window_index_list.insert(0, dynamic_window_index)
 
+    def estimate_single_byte_octets(self, codepoint: int, next_codepoint: int, window_position: int,
+                                    window_positions: tuple) -> tuple:
+        """
+        Estimate the octets encode outputs for a compressible character in single-byte mode, following the same
+        choices it makes.
+
+        :type codepoint: int
+        :param codepoint: The Unicode codepoint.
+        :type next_codepoint: int
+        :param next_codepoint: The Unicode codepoint after it, or None if there is none.
+        :type window_position: int
+        :param window_position: The position of the current dynamic window.
+        :type window_positions: tuple
+        :param window_positions: The dynamic window positions, most recently used first.
+        :rtype: tuple
+        :return: A tuple containing the number of octets, and the current dynamic window position and dynamic window
+                 positions afterwards.
+        """
+
+        # An ASCII character takes one octet, or two if it has to be quoted with SQ0.
+        if self.codepoint_is_ascii(codepoint):
+            return 2 if self.octet_conflicts_with_reserved_octet(codepoint) else 1, window_position, window_positions
+
+        # A character in the current dynamic window takes one octet.
+        if window_position <= codepoint <= window_position + 127:
+            return 1, window_position, window_positions
+
+        # A character in another dynamic window takes an SQn tag if the next character is in the current window, or an
+        # SCn tag which also selects that window.
+        dynamic_window_position = next((position for position in window_positions
+                                        if position <= codepoint <= position + 127), None)
+        if dynamic_window_position is not None:
+            if next_codepoint is not None and window_position <= next_codepoint <= window_position + 127:
+                return 2, window_position, window_positions
+            return 2, dynamic_window_position, (dynamic_window_position,) + tuple(
+                position for position in window_positions if position != dynamic_window_position)
+
+        # A BMP character in a static window is quoted with an SQn tag.
+        if self.codepoint_is_in_bmp(codepoint) and self.codepoint_fits_in_any_static_window(codepoint):
+            return 2, window_position, window_positions
+
+        # Any other character defines a new window with an SDn tag and a window key, or an SDX tag and two octets,
+        # replacing the least recently used window.
+        if self.codepoint_is_in_bmp(codepoint):
+            dynamic_window_position = self.find_window_position_for_codepoint(codepoint)
+            octets = 3
+        else:
+            dynamic_window_position = codepoint & ~0x7F
+            octets = 4
+        return octets, dynamic_window_position, (dynamic_window_position,) + window_positions[:7]
+
+    def estimate_leave_unicode_mode_octets(self, codepoint: int, window_positions: tuple) -> tuple:
+        """
+        Estimate the octets encode outputs for a compressible character that leaves Unicode mode, following the same
+        choices it makes.
+
+        :type codepoint: int
+        :param codepoint: The Unicode codepoint.
+        :type window_positions: tuple
+        :param window_positions: The dynamic window positions, most recently used first.
+        :rtype: tuple
+        :return: A tuple containing the number of octets, and the current dynamic window position and dynamic window
+                 positions afterwards.
+        """
+
+        # An ASCII character takes a UCn tag for the most recently used window, and an SQ0 tag if it has to be quoted.
+        if self.codepoint_is_ascii(codepoint):
+            return 3 if self.octet_conflicts_with_reserved_octet(codepoint) else 2, window_positions[0], \
+                window_positions
+
+        # A character in a dynamic window takes a UCn tag, which selects that window.
+        dynamic_window_position = next((position for position in window_positions
+                                        if position <= codepoint <= position + 127), None)
+        if dynamic_window_position is not None:
+            return 2, dynamic_window_position, window_positions
+
+        # Any other character defines a new window with a UDn tag and a window key, or a UDX tag and two octets,
+        # replacing the least recently used window.
+        if self.codepoint_is_in_bmp(codepoint):
+            dynamic_window_position = self.find_window_position_for_codepoint(codepoint)
+            octets = 3
+        else:
+            dynamic_window_position = codepoint & ~0x7F
+            octets = 4
+        return octets, dynamic_window_position, (dynamic_window_position,) + window_positions[:7]
+
+    def plan_modes_with_lookahead(self, unicode_string: str, start_index: int):
+        """
+        Work out the cheapest modes for up to lookahead characters, starting at a given character, and keep them in
+        planned_modes.
+
+        Both modes are followed through the characters, allowing the switches encode can make: entering Unicode mode
+        at a character that isn't compressible, and leaving it at one that is. Each mode keeps the dynamic windows of
+        the cheapest way to reach it, so single-byte costs follow the windows encode would use. Ties favor staying in
+        the same mode.
+
+        :type unicode_string: str
+        :param unicode_string: The Unicode string being encoded.
+        :type start_index: int
+        :param start_index: The index of the first character to plan.
+        """
+        end_index = min(start_index + self.lookahead, len(unicode_string))
+
+        # Each state is the cost of reaching a mode, the current dynamic window position and the dynamic window
+        # positions, most recently used first, or None if the mode can't be reached.
+        window_positions = tuple(self.dynamic_window_positions[dynamic_window_index]
+                                 for dynamic_window_index in self.used_dynamic_window_index_list)
+        single_byte_state = unicode_state = None
+        if self.current_mode == self.MODE_SINGLE_BYTE:
+            single_byte_state = (0, self.current_dynamic_window_position, window_positions)
+        else:
+            unicode_state = (0, self.current_dynamic_window_position, window_positions)
+
+        # Remember which mode each mode was reached from at each character, so the cheapest path can be traced back.
+        previous_modes = []
+
+        # Iterate through each character in the lookahead.
+        for index in range(start_index, end_index):
+            codepoint = ord(unicode_string[index])
+            next_codepoint = ord(unicode_string[index + 1]) if index + 1 < len(unicode_string) else None
+
+            new_single_byte_state = new_unicode_state = None
+            single_byte_previous_mode = unicode_previous_mode = None
+
+            # Is the character compressible? It can stay in single-byte mode, stay in Unicode mode, or leave Unicode
+            # mode.
+            if self.codepoint_is_compressible(codepoint):
+                if single_byte_state is not None:
+                    octets, window_position, window_positions = self.estimate_single_byte_octets(
+                        codepoint, next_codepoint, single_byte_state[1], single_byte_state[2])
+                    new_single_byte_state = (single_byte_state[0] + octets, window_position, window_positions)
+                    single_byte_previous_mode = self.MODE_SINGLE_BYTE
+
+                if unicode_state is not None:
+                    octets, window_position, window_positions = self.estimate_leave_unicode_mode_octets(
+                        codepoint, unicode_state[2])
+                    if new_single_byte_state is None or unicode_state[0] + octets < new_single_byte_state[0]:
+                        new_single_byte_state = (unicode_state[0] + octets, window_position, window_positions)
+                        single_byte_previous_mode = self.MODE_UNICODE
+
+                    # In Unicode mode, a character takes two octets, three if it needs a UQU tag, or four for a
+                    # supplementary character.
+                    if not self.codepoint_is_in_bmp(codepoint):
+                        octets = 4
+                    elif self.octet_conflicts_with_reserved_unicode_hbyte(codepoint >> 8):
+                        octets = 3
+                    else:
+                        octets = 2
+                    new_unicode_state = (unicode_state[0] + octets, unicode_state[1], unicode_state[2])
+                    unicode_previous_mode = self.MODE_UNICODE
+
+            # The character isn't compressible. It takes two octets in Unicode mode, and single-byte mode can either
+            # quote it with an SQU tag or enter Unicode mode with an SCU tag.
+            else:
+                if unicode_state is not None:
+                    new_unicode_state = (unicode_state[0] + 2, unicode_state[1], unicode_state[2])
+                    unicode_previous_mode = self.MODE_UNICODE
+
+                if single_byte_state is not None:
+                    new_single_byte_state = (single_byte_state[0] + 3, single_byte_state[1], single_byte_state[2])
+                    single_byte_previous_mode = self.MODE_SINGLE_BYTE
+                    if new_unicode_state is None or single_byte_state[0] + 3 < new_unicode_state[0]:
+                        new_unicode_state = (single_byte_state[0] + 3, single_byte_state[1], single_byte_state[2])
+                        unicode_previous_mode = self.MODE_SINGLE_BYTE
+
+            single_byte_state, unicode_state = new_single_byte_state, new_unicode_state
+            previous_modes.append((single_byte_previous_mode, unicode_previous_mode))
+
+        # Pick the cheaper mode at the end, preferring the current mode on a tie.
+        if unicode_state is None:
+            mode = self.MODE_SINGLE_BYTE
+        elif single_byte_state is None:
+            mode = self.MODE_UNICODE
+        elif single_byte_state[0] != unicode_state[0]:
+            mode = self.MODE_SINGLE_BYTE if single_byte_state[0] < unicode_state[0] else self.MODE_UNICODE
+        else:
+            mode = self.current_mode
+
+        # Trace the cheapest path back to the first character.
+        planned_modes = [0] * len(previous_modes)
+        for index in range(len(previous_modes) - 1, -1, -1):
+            planned_modes[index] = mode
+            mode = previous_modes[index][0 if mode == self.MODE_SINGLE_BYTE else 1]
+
+        self.planned_modes = planned_modes
+        self.planned_modes_start_index = start_index
+
+    def choose_mode_with_lookahead(self, unicode_string: str, current_index: int) -> int:
+        """
+        Choose the mode the current character should be encoded in, from a plan made by plan_modes_with_lookahead.
+
+        A plan covers lookahead characters, and is followed for the first half of them before a new plan is made, so
+        the work for each character is constant on average for a given lookahead. A new plan is also made if encoding
+        didn't follow the plan.
+
+        :type unicode_string: str
+        :param unicode_string: The Unicode string being encoded.
+        :type current_index: int
+        :param current_index: The index of the current character.
+        :rtype: int
+        :return: MODE_SINGLE_BYTE or MODE_UNICODE.
+        """
+        plan_index = current_index - self.planned_modes_start_index if self.planned_modes is not None else -1
+
+        # Is the current character outside the part of the plan we follow, or is the mode we are in not the one the
+        # plan expected?
+        if not 0 <= plan_index < max(1, self.lookahead // 2) or plan_index >= len(self.planned_modes) \
+                or (plan_index > 0 and self.planned_modes[plan_index - 1] != self.current_mode):
+            self.plan_modes_with_lookahead(unicode_string, current_index)
+            plan_index = 0
+
+        return self.planned_modes[plan_index]
+
     def train(self, unicode_string: str):
         """
         Train the compressor by analyzing a Unicode string and rearranging the dynamic window availability.
@@ -449,22 +847,212 @@ class SCSUEncoder(SCSU):
         dynamic_window_index_list = sorted(dynamic_window_usage, key=dynamic_window_usage.get, reverse=True)
         self.used_dynamic_window_index_list = dynamic_window_index_list
 
+    def prefetch_windows(self, unicode_string: str):
+        """
+        Scan a Unicode string and, if it needs more than eight dynamic windows, define the ones that its characters use
+        most. The definitions are output at the start of the next encoded byte array, which must encode the same string.
+
+        While that string is encoded, a new window replaces the window that will be needed again furthest in the
+        future, rather than the least recently used one, so windows are redefined as rarely as possible.
+
+        :type unicode_string: str
+        :param unicode_string: The Unicode string to analyze.
+        """
+
+        # Define a dictionary for counting the use of each window position, one for remembering the window position
+        # for each codepoint we've seen, and one for the indexes of the characters in each half-block.
+        window_position_usage = {}
+        codepoint_window_positions = {}
+        half_block_occurrences = {}
+
+        # Iterate through each character.
+        for current_index, current_character in enumerate(unicode_string):
+
+            # Convert the current character to an integer.
+            current_codepoint = ord(current_character)
+
+            # Skip codepoints that don't need a dynamic window: ASCII and incompressible codepoints.
+            if self.codepoint_is_ascii(current_codepoint) or not self.codepoint_is_compressible(current_codepoint):
+                continue
+
+            # Remember where the half-block the current codepoint is in is used.
+            half_block_occurrences.setdefault(current_codepoint >> 7, []).append(current_index)
+
+            # Only count window positions for codepoints in the Basic Multilingual Plane.
+            if not self.codepoint_is_in_bmp(current_codepoint):
+                continue
+
+            # Look up the window position for the current codepoint, if we've seen it before.
+            window_position = codepoint_window_positions.get(current_codepoint)
+
+            if window_position is None:
+
+                # Use the dynamic window the current codepoint already fits in, or find a window position for it.
+                if self.codepoint_fits_in_any_dynamic_window(current_codepoint):
+                    window_position = self.dynamic_window_positions[
+                        self.find_dynamic_window_index_for_codepoint(current_codepoint)]
+                else:
+                    window_position = self.find_window_position_for_codepoint(current_codepoint)
+
+                codepoint_window_positions[current_codepoint] = window_position
+
+            # Increment the count for the window position.
+            window_position_usage[window_position] = window_position_usage.get(window_position, 0) + 1
+
+        # Remember where each half-block is used, so windows defined while encoding replace the right windows.
+        self.half_block_occurrences = half_block_occurrences
+        self.prefetched_character_offset = 0
+
+        # If all the window positions fit in the eight dynamic windows, no window is ever redefined mid-stream. Each is
+        # then best defined where it is first used, since the definition also switches to it.
+        if len(window_position_usage) <= 8:
+            return
+
+        # Keep the eight most used window positions, least used first.
+        wanted_window_positions = sorted(window_position_usage, key=window_position_usage.get, reverse=True)[:8]
+        wanted_window_positions.reverse()
+
+        # Find the dynamic window indexes whose window positions aren't wanted, so they can be redefined.
+        unwanted_dynamic_window_indexes = [dynamic_window_index for dynamic_window_index, dynamic_window_position
+                                           in enumerate(self.dynamic_window_positions)
+                                           if dynamic_window_position not in wanted_window_positions]
+
+        # Iterate through each wanted window position, least used first.
+        for window_position in wanted_window_positions:
+
+            # Is the window position already defined?
+            if window_position in self.dynamic_window_positions:
+                dynamic_window_index = self.dynamic_window_positions.index(window_position)
+
+            # Redefine an unwanted dynamic window with the window position, and remember to output the definition.
+            else:
+                dynamic_window_index = unwanted_dynamic_window_indexes.pop()
+                window_key = self.get_window_key_for_window_position(window_position)
+                self.dynamic_window_keys[dynamic_window_index] = window_key
+                self.dynamic_window_positions[dynamic_window_index] = window_position
+                self.pending_window_definitions.append((dynamic_window_index, window_key))
+
+            # Move the dynamic window index to the front of the used dynamic window index list, so the most used window
+            # ends up at the front.
+            self.move_dynamic_window_index_to_front(dynamic_window_index)
+
+    def output_pending_window_definitions(self, encoded_byte_array: bytearray):
+        """
+        Output the dynamic window definitions made by prefetch_windows.
+
+        :type encoded_byte_array: bytearray
+        :param encoded_byte_array: The byte array to output the definitions to.
+        """
+
+        # Iterate through each definition, least used window first.
+        for dynamic_window_index, window_key in self.pending_window_definitions:
+
+            # Output an SDn tag, or a UDn tag if we are in Unicode mode, followed by the window key, and switch to
+            # single-byte mode.
+            if self.current_mode == self.MODE_SINGLE_BYTE:
+                encoded_byte_array.append(self.TAG_SDn[dynamic_window_index])
+            else:
+                encoded_byte_array.append(self.TAG_UDn[dynamic_window_index])
+                self.current_mode = self.MODE_SINGLE_BYTE
+            encoded_byte_array.append(window_key)
+
+            # Set the current dynamic window to the newly defined dynamic window.
+            self.current_dynamic_window_key = window_key
+            self.current_dynamic_window_position = self.dynamic_window_positions[dynamic_window_index]
+
+        # The last window defined is the current one, but encoding should start in the most used window. Output an SCn
+        # tag to switch to it if it isn't already current.
+        if self.pending_window_definitions:
+            dynamic_window_index = self.used_dynamic_window_index_list[0]
+            if self.current_dynamic_window_position != self.dynamic_window_positions[dynamic_window_index]:
+                encoded_byte_array.append(self.TAG_SCn[dynamic_window_index])
+                self.current_dynamic_window_key = self.dynamic_window_keys[dynamic_window_index]
+                self.current_dynamic_window_position = self.dynamic_window_positions[dynamic_window_index]
+
+        self.pending_window_definitions = []
+
+    def save_state(self) -> tuple:
+        """
+        Take a snapshot of the internal codec status.
+
+        :rtype: tuple
+        :return: The snapshot.
+        """
+        return self.current_mode, list(self.dynamic_window_keys), list(self.dynamic_window_positions), \
+            self.current_dynamic_window_key, self.current_dynamic_window_position, \
+            list(self.used_dynamic_window_index_list), list(self.pending_window_definitions), \
+            self.prefetched_character_offset
+
+    def restore_state(self, state: tuple):
+        """
+        Restore the internal codec status from a snapshot taken with save_state.
+
+        :type state: tuple
+        :param state: The snapshot.
+        """
+        self.current_mode, dynamic_window_keys, dynamic_window_positions, self.current_dynamic_window_key, \
+            self.current_dynamic_window_position, used_dynamic_window_index_list, pending_window_definitions, \
+            self.prefetched_character_offset = state
+        self.dynamic_window_keys = list(dynamic_window_keys)
+        self.dynamic_window_positions = list(dynamic_window_positions)
+        self.used_dynamic_window_index_list = list(used_dynamic_window_index_list)
+        self.pending_window_definitions = list(pending_window_definitions)
+
     def encode(self, unicode_string: str) -> bytearray:
         """
         Encode a Unicode string into a SCSU byte array.
 
+        With a lookahead, the string is encoded both with and without it from the same state, and the shorter result
+        is kept along with the state it leaves, so looking ahead never makes the output longer.
+
         :type unicode_string: str
         :param unicode_string: The Unicode string to encode.
         :rtype: bytearray
         :return: The encoded byte array.
         """
 
+        # Without a lookahead, decide whether to switch modes by looking at the next character.
+        if self.lookahead is None:
+            return self.encode_with_mode_rule(unicode_string, False)
+
+        # Encode the string both ways from the same state.
+        state = self.save_state()
+        lookahead_byte_array = self.encode_with_mode_rule(unicode_string, True)
+        lookahead_state = self.save_state()
+        self.restore_state(state)
+        encoded_byte_array = self.encode_with_mode_rule(unicode_string, False)
+
+        # Keep the lookahead result if it is shorter.
+        if len(lookahead_byte_array) < len(encoded_byte_array):
+            self.restore_state(lookahead_state)
+            return lookahead_byte_array
+        return encoded_byte_array
+
+    def encode_with_mode_rule(self, unicode_string: str, use_lookahead: bool) -> bytearray:
+        """
+        Encode a Unicode string into a SCSU byte array, deciding whether to switch modes either with
+        choose_mode_with_lookahead or by looking at the next character.
+
+        :type unicode_string: str
+        :param unicode_string: The Unicode string to encode.
+        :type use_lookahead: bool
+        :param use_lookahead: True to use choose_mode_with_lookahead; false to look at the next character.
+        :rtype: bytearray
+        :return: The encoded byte array.
+        """
+
         # Get the last index of the Unicode string.
         last_index = len(unicode_string) - 1
 
         # Temporarily store the return value in a byte array.
         encoded_byte_array = bytearray()
 
+        # Output any dynamic window definitions made by prefetch_windows.
+        self.output_pending_window_definitions(encoded_byte_array)
+
+        # Forget any plan made by choose_mode_with_lookahead for an earlier string.
+        self.planned_modes = None
+
         # Iterate through each character.
         for current_index, current_character in enumerate(unicode_string):
 
@@ -566,7 +1154,7 @@ class SCSUEncoder(SCSU):
                         else:
 
                             # Get an unused (or rarely used) dynamic window index.
-                            unused_dynamic_window_index = self.get_unused_dynamic_window_index()
+                            unused_dynamic_window_index = self.get_unused_dynamic_window_index(current_index)
                             new_dynamic_window_index = unused_dynamic_window_index
 
                             # Find a window position that the current character fits in.
@@ -603,7 +1191,7 @@ class SCSUEncoder(SCSU):
                     else:
 
                         # Get an unused (or rarely used) dynamic window index.
-                        unused_dynamic_window_index = self.get_unused_dynamic_window_index()
+                        unused_dynamic_window_index = self.get_unused_dynamic_window_index(current_index)
                         new_dynamic_window_index = unused_dynamic_window_index
 
                         # Encoding the new dynamic window position for a supplementary codepoint only involves clearing
@@ -614,6 +1202,10 @@ class SCSUEncoder(SCSU):
                         self.current_dynamic_window_key = None
                         self.current_dynamic_window_position = new_dynamic_window_position
 
+                        # Remember the new dynamic window key and position in the key and position lists.
+                        self.dynamic_window_keys[new_dynamic_window_index] = None
+                        self.dynamic_window_positions[new_dynamic_window_index] = new_dynamic_window_position
+
                         # Move the new dynamic window index to the front of the userd dynamic window index list.
                         self.move_dynamic_window_index_to_front(new_dynamic_window_index)
 
@@ -638,9 +1230,17 @@ class SCSUEncoder(SCSU):
                 # The current codepoint is not compressible.
                 else:
 
+                    # Is quoting the current codepoint estimated to be cheaper than entering Unicode mode?
+                    if use_lookahead:
+                        quote_codepoint = self.choose_mode_with_lookahead(unicode_string, current_index) \
+                            == self.MODE_SINGLE_BYTE
+
                     # Is the current codepoint in the Basic Multilingual Plane, and is the next codepoint compressible?
-                    if self.codepoint_is_in_bmp(current_codepoint) and \
-                                    next_codepoint is not None and self.codepoint_is_compressible(next_codepoint):
+                    else:
+                        quote_codepoint = self.codepoint_is_in_bmp(current_codepoint) and \
+                            next_codepoint is not None and self.codepoint_is_compressible(next_codepoint)
+
+                    if quote_codepoint:
 
                         # Output an SQU tag.
                         encoded_byte_array.append(self.TAG_SQU)
@@ -652,8 +1252,7 @@ class SCSUEncoder(SCSU):
                         encoded_byte_array.append(hbyte)
                         encoded_byte_array.append(lbyte)
 
-                    # The current codepoint is not in the Basic Multilingual Plane, or the next codepoint is not
-                    # compressible.
+                    # Entering Unicode mode is cheaper.
                     else:
 
                         # Output an SCU tag and switch to Unicode mode.
@@ -679,9 +1278,17 @@ class SCSUEncoder(SCSU):
             # We are in Unicode mode.
             else:
 
+                # Is the current codepoint compressible, and is leaving Unicode mode estimated to be cheaper?
+                if use_lookahead:
+                    leave_unicode_mode = self.codepoint_is_compressible(current_codepoint) \
+                        and self.choose_mode_with_lookahead(unicode_string, current_index) == self.MODE_SINGLE_BYTE
+
                 # Is the current codepoint compressible, and is the next codepoint compressible?
-                if self.codepoint_is_compressible(current_codepoint) \
-                        and next_codepoint is not None and self.codepoint_is_compressible(next_codepoint):
+                else:
+                    leave_unicode_mode = self.codepoint_is_compressible(current_codepoint) \
+                        and next_codepoint is not None and self.codepoint_is_compressible(next_codepoint)
+
+                if leave_unicode_mode:
 
                     # Is the current codepoint in the ASCII range?
                     if self.codepoint_is_ascii(current_codepoint):
@@ -695,16 +1302,19 @@ class SCSUEncoder(SCSU):
                         # Get the window key for the new new dynamic window position.
                         new_dynamic_window_key = self.dynamic_window_keys[new_dynamic_window_index]
 
-                        # Encode the current codepoint as an octet in the current dynamic window.
-                        new_dynamic_window_octet = \
-                            self.codepoint_in_dynamic_window_as_encoded_octet(current_codepoint,
-                                                                              new_dynamic_window_position)
-
                         # Output a UCn tag for the last-used dynamic window and switch to single-byte mode.
                         encoded_byte_array.append(self.TAG_UCn[new_dynamic_window_index])
-                        encoded_byte_array.append(new_dynamic_window_octet)
                         self.current_mode = self.MODE_SINGLE_BYTE
 
+                        # Does the octet conflict with a reserved octet?
+                        if self.octet_conflicts_with_reserved_octet(current_codepoint):
+
+                            # Output an SQ0 tag.
+                            encoded_byte_array.append(self.TAG_SQ0)
+
+                        # Output the codepoint as a single byte.
+                        encoded_byte_array.append(current_codepoint)
+
                         # Set the current dynamic window to the new dynamic window.
                         self.current_dynamic_window_key = new_dynamic_window_key
                         self.current_dynamic_window_position = new_dynamic_window_position
@@ -739,7 +1349,7 @@ class SCSUEncoder(SCSU):
                     elif self.codepoint_is_in_bmp(current_codepoint):
 
                         # Get an unused (or rarely used) dynamic window index.
-                        unused_dynamic_window_index = self.get_unused_dynamic_window_index()
+                        unused_dynamic_window_index = self.get_unused_dynamic_window_index(current_index)
                         new_dynamic_window_index = unused_dynamic_window_index
 
                         # Find a window position that the current character fits in.
@@ -753,6 +1363,10 @@ class SCSUEncoder(SCSU):
                         self.current_dynamic_window_key = new_dynamic_window_key
                         self.current_dynamic_window_position = new_dynamic_window_position
 
+                        # Remember the new dynamic window key and position in the key and position lists.
+                        self.dynamic_window_keys[new_dynamic_window_index] = new_dynamic_window_key
+                        self.dynamic_window_positions[new_dynamic_window_index] = new_dynamic_window_position
+
                         # Move the new dynamic window index to the front of the used dynamic window index list.
                         self.move_dynamic_window_index_to_front(new_dynamic_window_index)
 
@@ -774,7 +1388,7 @@ class SCSUEncoder(SCSU):
                     else:
 
                         # Get an unused (or rarely used) dynamic window index.
-                        unused_dynamic_window_index = self.get_unused_dynamic_window_index()
+                        unused_dynamic_window_index = self.get_unused_dynamic_window_index(current_index)
                         new_dynamic_window_index = unused_dynamic_window_index
 
                         # Encoding the new dynamic window position for a supplementary codepoint only involves clearing
@@ -785,6 +1399,10 @@ class SCSUEncoder(SCSU):
                         self.current_dynamic_window_key = None
                         self.current_dynamic_window_position = new_dynamic_window_position
 
+                        # Remember the new dynamic window key and position in the key and position lists.
+                        self.dynamic_window_keys[new_dynamic_window_index] = None
+                        self.dynamic_window_positions[new_dynamic_window_index] = new_dynamic_window_position
+
                         # Move the new dynamic window index to the front of the userd dynamic window index list.
                         self.move_dynamic_window_index_to_front(new_dynamic_window_index)
 
@@ -807,7 +1425,7 @@ class SCSUEncoder(SCSU):
                         # Output the encoded codepoint.
                         encoded_byte_array.append(new_dynamic_window_octet)
 
-                # The current codepoint and the next codepoint are not both compressible.
+                # Staying in Unicode mode is cheaper.
                 else:
 
                     # Encode the current codepoint as a UTF-16 big-endian octet array.
@@ -827,12 +1445,1105 @@ class SCSUEncoder(SCSU):
                         encoded_byte_array.append(hbyte)
                         encoded_byte_array.append(lbyte)
 
+        # Keep track of where the next string starts in the string analyzed by prefetch_windows.
+        if self.prefetched_character_offset is not None:
+            self.prefetched_character_offset += len(unicode_string)
+
+        return encoded_byte_array
+
+    def encode_adaptive(self, unicode_string: str) -> bytearray:
+        """
+        Encode a Unicode string as whichever of SCSU, UTF-8 and UTF-16BE is smallest, preceded by a format octet.
+
+        Each record is a single segment with one format octet; formats aren't switched within a record. The SCSU is
+        produced by a separate encoder starting from the initial state, so each record can be decoded on its own. The
+        state of this encoder, including anything set up by train or prefetch_windows, is left untouched and doesn't
+        affect the record. UTF-16BE is sized without encoding it, and the string is only encoded as SCSU when a lower
+        bound for the SCSU length shows that it could beat the others.
+
+        :type unicode_string: str
+        :param unicode_string: The Unicode string to encode.
+        :rtype: bytearray
+        :return: The format octet followed by the encoded string.
+        """
+
+        # Start with UTF-8, which wins ties because it is the cheapest to decode.
+        utf8_byte_array = unicode_string.encode('UTF-8')
+        best_format = self.FORMAT_UTF8
+        best_length = len(utf8_byte_array)
+
+        # Is UTF-16BE smaller?
+        utf16_length = self.get_utf16_length(unicode_string)
+        if utf16_length < best_length:
+            best_format = self.FORMAT_UTF16BE
+            best_length = utf16_length
+
+        # Could SCSU be smaller? If so, encode the string from the initial state and check.
+        scsu_byte_array = None
+        if self.get_scsu_length_lower_bound(unicode_string) < best_length:
+            scsu_byte_array = SCSUEncoder(self.lookahead).encode(unicode_string)
+            if len(scsu_byte_array) < best_length:
+                best_format = self.FORMAT_SCSU
+
+        # Output the format octet followed by the encoded string.
+        encoded_byte_array = bytearray((best_format,))
+        if best_format == self.FORMAT_SCSU:
+            encoded_byte_array += scsu_byte_array
+        elif best_format == self.FORMAT_UTF16BE:
+            encoded_byte_array += unicode_string.encode('UTF-16BE')
+        else:
+            encoded_byte_array += utf8_byte_array
+
         return encoded_byte_array
 
 
 class SCSUDecoder(SCSU):
 
+    current_mode = None
+
+    dynamic_window_positions = None
+
+    current_dynamic_window_index = None
+
+    pending_high_surrogate = None
+
+    position = None
+
     def __init__(self):
+        """
+        Instantiate a SCSU decoder object.
+        """
+
+        self.reset()
+
+    def reset(self):
+        """
+        Reset the internal codec status.
+        """
+        self.current_mode = self.MODE_SINGLE_BYTE
+
+        # Reuse the dynamic window position list if we already have one, so resetting doesn't allocate.
+        if self.dynamic_window_positions is None:
+            self.dynamic_window_positions = list(self.default_dynamic_window_positions)
+        else:
+            self.dynamic_window_positions[:] = self.default_dynamic_window_positions
+
+        self.current_dynamic_window_index = 0
+
+        self.pending_high_surrogate = None
+
+    def get_packed_state(self) -> int:
+        """
+        Take a snapshot of the internal codec status, packed into an integer that is zero for the initial status.
+
+        The mode is in bit 0, the current dynamic window index in bits 1 to 3, one more than the pending high
+        surrogate's offset from 0xD800 in bits 4 to 14, then 21 bits for each dynamic window position, exclusive-ored
+        with its default position.
+
+        :rtype: int
+        :return: The packed snapshot.
+        """
+        packed_state = (self.current_mode - self.MODE_SINGLE_BYTE) | (self.current_dynamic_window_index << 1)
+        if self.pending_high_surrogate is not None:
+            packed_state |= (self.pending_high_surrogate - 0xD800 + 1) << 4
+        for dynamic_window_index, dynamic_window_position in enumerate(self.dynamic_window_positions):
+            default_dynamic_window_position = self.default_dynamic_window_positions[dynamic_window_index]
+            packed_state |= (dynamic_window_position ^ default_dynamic_window_position) \
+                << (15 + 21 * dynamic_window_index)
+        return packed_state
+
+    def set_packed_state(self, packed_state: int):
+        """
+        Restore the internal codec status from a snapshot taken with get_packed_state.
+
+        :type packed_state: int
+        :param packed_state: The packed snapshot.
+        """
+        self.current_mode = (packed_state & 0x1) + self.MODE_SINGLE_BYTE
+        self.current_dynamic_window_index = (packed_state >> 1) & 0x7
+        pending_high_surrogate = (packed_state >> 4) & 0x7FF
+        self.pending_high_surrogate = pending_high_surrogate + 0xD800 - 1 if pending_high_surrogate else None
+        for dynamic_window_index in range(8):
+            self.dynamic_window_positions[dynamic_window_index] = \
+                ((packed_state >> (15 + 21 * dynamic_window_index)) & 0x1FFFFF) \
+                ^ self.default_dynamic_window_positions[dynamic_window_index]
 
-        # TODO: Write a decoder!
-        raise NotImplementedError('No SCSU decoder has been written yet.')
+    @staticmethod
+    def create_decode_error(byte_array, start: int, end: int, reason: str) -> UnicodeDecodeError:
+        """
+        Create an exception describing malformed SCSU input.
+
+        :type byte_array: bytes
+        :param byte_array: The SCSU byte array being decoded.
+        :type start: int
+        :param start: The index of the first offending octet.
+        :type end: int
+        :param end: The index after the last offending octet.
+        :type reason: str
+        :param reason: A description of the problem.
+        :rtype: UnicodeDecodeError
+        :return: The exception to raise.
+        """
+        return UnicodeDecodeError('SCSU', bytes(byte_array), start, end, reason)
+
+    def combine_code_unit(self, code_unit: int) -> int:
+        """
+        Combine a UTF-16 code unit with a previously seen high surrogate.
+
+        :type code_unit: int
+        :param code_unit: The UTF-16 code unit.
+        :rtype: int
+        :return: The Unicode codepoint, an earlier high surrogate that wasn't followed by a low surrogate, or None if
+                 the code unit is a high surrogate waiting for its low surrogate.
+        """
+
+        # Is the code unit a high surrogate? Keep it until the next code unit, and pass through any high surrogate we
+        # were already keeping, since it isn't followed by a low surrogate.
+        if 0xD800 <= code_unit <= 0xDBFF:
+            lone_high_surrogate = self.pending_high_surrogate
+            self.pending_high_surrogate = code_unit
+            return lone_high_surrogate
+
+        # Is the code unit a low surrogate following a high surrogate?
+        if 0xDC00 <= code_unit <= 0xDFFF and self.pending_high_surrogate is not None:
+            high_surrogate = self.pending_high_surrogate
+            self.pending_high_surrogate = None
+            return 0x10000 + ((high_surrogate - 0xD800) << 10) + (code_unit - 0xDC00)
+
+        return code_unit
+
+    def iterate_codepoints(self, byte_array, start: int = 0, end: int = None, final: bool = True):
+        """
+        Decode a SCSU byte array one Unicode codepoint at a time.
+
+        After each codepoint is produced, the position attribute holds the index of the octet following it. If the
+        input isn't final, decoding stops before an incomplete sequence at the end, and the position attribute holds the
+        index of its first octet.
+        Malformed input raises UnicodeDecodeError holding only the octets between start and end, with positions
+        relative to start.
+
+        :type byte_array: bytes
+        :param byte_array: The SCSU byte array (or memoryview) to decode.
+        :type start: int
+        :param start: The index of the first octet to decode.
+        :type end: int
+        :param end: The index after the last octet to decode, or None to decode to the end of the byte array.
+        :type final: bool
+        :param final: False if more octets may follow the end of the byte array.
+        :rtype: generator
+        :return: A generator of Unicode codepoints.
+        """
+
+        # Decode to the end of the byte array if no end was given.
+        if end is None:
+            end = len(byte_array)
+
+        # Errors describe only the octets being decoded, not the rest of a buffer that holds many values.
+        def create_decode_error(error_start: int, error_end: int, reason: str) -> UnicodeDecodeError:
+            return self.create_decode_error(byte_array[start:end], error_start - start, error_end - start, reason)
+
+        dynamic_window_positions = self.dynamic_window_positions
+
+        current_index = start
+        self.position = start
+
+        while current_index < end:
+
+            # Remember where the current sequence starts, then read its first octet.
+            sequence_index = current_index
+            octet = byte_array[current_index]
+            current_index += 1
+
+            # Are we in single-byte mode?
+            if self.current_mode == self.MODE_SINGLE_BYTE:
+
+                # Is the octet in the current dynamic window?
+                if octet >= 0x80:
+                    codepoint = dynamic_window_positions[self.current_dynamic_window_index] + octet - 0x80
+
+                # Is the octet an ASCII character, or one of the control characters passed through as-is?
+                elif octet >= 0x20 or octet == 0x00 or octet == 0x09 or octet == 0x0A or octet == 0x0D:
+                    codepoint = octet
+
+                # Is the octet an SQn tag?
+                elif octet <= self.TAG_SQ7:
+                    if current_index >= end:
+                        if final:
+                            raise create_decode_error(sequence_index, end, 'truncated SQn sequence')
+                        current_index = sequence_index
+                        break
+
+                    # Quote a single character from a static or dynamic window.
+                    quoted_octet = byte_array[current_index]
+                    current_index += 1
+                    if quoted_octet < 0x80:
+                        codepoint = self.static_window_positions[octet - self.TAG_SQ0] + quoted_octet
+                    else:
+                        codepoint = dynamic_window_positions[octet - self.TAG_SQ0] + quoted_octet - 0x80
+
+                # Is the octet an SDX tag?
+                elif octet == self.TAG_SDX:
+                    if current_index + 2 > end:
+                        if final:
+                            raise create_decode_error(sequence_index, end, 'truncated SDX sequence')
+                        current_index = sequence_index
+                        break
+
+                    # Define a dynamic window for the supplementary code space and select it.
+                    dynamic_window_index, dynamic_window_position = \
+                        self.decode_supplementary_codepoint_window_base(byte_array[current_index],
+                                                                        byte_array[current_index + 1])
+                    current_index += 2
+                    dynamic_window_positions[dynamic_window_index] = dynamic_window_position
+                    self.current_dynamic_window_index = dynamic_window_index
+                    continue
+
+                # Is the octet an SQU tag?
+                elif octet == self.TAG_SQU:
+                    if current_index + 2 > end:
+                        if final:
+                            raise create_decode_error(sequence_index, end, 'truncated SQU sequence')
+                        current_index = sequence_index
+                        break
+
+                    # Quote a single UTF-16 code unit.
+                    codepoint = self.combine_code_unit((byte_array[current_index] << 8) | byte_array[current_index + 1])
+                    current_index += 2
+                    if codepoint is None:
+                        continue
+
+                # Is the octet an SCU tag?
+                elif octet == self.TAG_SCU:
+                    self.current_mode = self.MODE_UNICODE
+                    continue
+
+                # Is the octet an SCn tag?
+                elif self.TAG_SC0 <= octet <= self.TAG_SC7:
+                    self.current_dynamic_window_index = octet - self.TAG_SC0
+                    continue
+
+                # Is the octet an SDn tag?
+                elif self.TAG_SD0 <= octet <= self.TAG_SD7:
+                    if current_index >= end:
+                        if final:
+                            raise create_decode_error(sequence_index, end, 'truncated SDn sequence')
+                        current_index = sequence_index
+                        break
+
+                    # Define a dynamic window and select it.
+                    dynamic_window_position = self.get_window_position_table()[byte_array[current_index]]
+                    current_index += 1
+                    if dynamic_window_position is None:
+                        raise create_decode_error(sequence_index, current_index, 'reserved window key')
+                    dynamic_window_positions[octet - self.TAG_SD0] = dynamic_window_position
+                    self.current_dynamic_window_index = octet - self.TAG_SD0
+                    continue
+
+                # The octet is the reserved SRX tag.
+                else:
+                    raise create_decode_error(sequence_index, current_index, 'reserved tag')
+
+            # We are in Unicode mode.
+            else:
+
+                # Is the octet a UCn tag?
+                if self.TAG_UC0 <= octet <= self.TAG_UC7:
+                    self.current_dynamic_window_index = octet - self.TAG_UC0
+                    self.current_mode = self.MODE_SINGLE_BYTE
+                    continue
+
+                # Is the octet a UDn tag?
+                elif self.TAG_UD0 <= octet <= self.TAG_UD7:
+                    if current_index >= end:
+                        if final:
+                            raise create_decode_error(sequence_index, end, 'truncated UDn sequence')
+                        current_index = sequence_index
+                        break
+
+                    # Define a dynamic window, select it and switch to single-byte mode.
+                    dynamic_window_position = self.get_window_position_table()[byte_array[current_index]]
+                    current_index += 1
+                    if dynamic_window_position is None:
+                        raise create_decode_error(sequence_index, current_index, 'reserved window key')
+                    dynamic_window_positions[octet - self.TAG_UD0] = dynamic_window_position
+                    self.current_dynamic_window_index = octet - self.TAG_UD0
+                    self.current_mode = self.MODE_SINGLE_BYTE
+                    continue
+
+                # Is the octet a UDX tag?
+                elif octet == self.TAG_UDX:
+                    if current_index + 2 > end:
+                        if final:
+                            raise create_decode_error(sequence_index, end, 'truncated UDX sequence')
+                        current_index = sequence_index
+                        break
+
+                    # Define a dynamic window for the supplementary code space, select it and switch to single-byte
+                    # mode.
+                    dynamic_window_index, dynamic_window_position = \
+                        self.decode_supplementary_codepoint_window_base(byte_array[current_index],
+                                                                        byte_array[current_index + 1])
+                    current_index += 2
+                    dynamic_window_positions[dynamic_window_index] = dynamic_window_position
+                    self.current_dynamic_window_index = dynamic_window_index
+                    self.current_mode = self.MODE_SINGLE_BYTE
+                    continue
+
+                # Is the octet the reserved URX tag?
+                elif octet == self.TAG_URX:
+                    raise create_decode_error(sequence_index, current_index, 'reserved tag')
+
+                # Is the octet a UQU tag?
+                elif octet == self.TAG_UQU:
+                    if current_index + 2 > end:
+                        if final:
+                            raise create_decode_error(sequence_index, end, 'truncated UQU sequence')
+                        current_index = sequence_index
+                        break
+
+                    # Quote a single UTF-16 code unit.
+                    codepoint = self.combine_code_unit((byte_array[current_index] << 8) | byte_array[current_index + 1])
+                    current_index += 2
+                    if codepoint is None:
+                        continue
+
+                # The octet is the high byte of a UTF-16 code unit.
+                else:
+                    if current_index >= end:
+                        if final:
+                            raise create_decode_error(sequence_index, end, 'truncated UTF-16 code unit')
+                        current_index = sequence_index
+                        break
+
+                    codepoint = self.combine_code_unit((octet << 8) | byte_array[current_index])
+                    current_index += 1
+                    if codepoint is None:
+                        continue
+
+            # A high surrogate that isn't followed by a low surrogate is passed through on its own. (If the codepoint
+            # is itself a lone high surrogate, the pending one came after it.)
+            if self.pending_high_surrogate is not None and not 0xD800 <= codepoint <= 0xDBFF:
+                self.position = sequence_index
+                yield self.pending_high_surrogate
+                self.pending_high_surrogate = None
+
+            self.position = current_index
+            yield codepoint
+
+        # A high surrogate at the end of the final input is passed through on its own.
+        if final and self.pending_high_surrogate is not None:
+            self.position = current_index
+            yield self.pending_high_surrogate
+            self.pending_high_surrogate = None
+
+        self.position = current_index
+
+    def decode(self, byte_array) -> str:
+        """
+        Decode a SCSU byte array into a Unicode string.
+
+        :type byte_array: bytes
+        :param byte_array: The SCSU byte array to decode.
+        :rtype: str
+        :return: The decoded Unicode string.
+        """
+        return ''.join(map(chr, self.iterate_codepoints(byte_array)))
+
+    def decode_adaptive(self, byte_array) -> str:
+        """
+        Decode a byte array produced by SCSUEncoder.encode_adaptive into a Unicode string.
+
+        :type byte_array: bytes
+        :param byte_array: The format octet followed by the encoded string.
+        :rtype: str
+        :return: The decoded Unicode string.
+        """
+        if len(byte_array) == 0:
+            raise self.create_decode_error(byte_array, 0, 0, 'missing format octet')
+
+        string_format = byte_array[0]
+
+        # Is the string encoded as SCSU?
+        if string_format == self.FORMAT_SCSU:
+            self.reset()
+            return ''.join(map(chr, self.iterate_codepoints(byte_array, 1)))
+
+        # Is the string encoded as UTF-8?
+        if string_format == self.FORMAT_UTF8:
+            return str(memoryview(byte_array)[1:], 'UTF-8')
+
+        # Is the string encoded as UTF-16BE?
+        if string_format == self.FORMAT_UTF16BE:
+            return str(memoryview(byte_array)[1:], 'UTF-16BE')
+
+        raise self.create_decode_error(byte_array, 0, 1, 'unknown format octet')
+
+    def decode_many(self, buffer, offsets, lazy: bool = False):
+        """
+        Decode many SCSU values stored back to back in a single buffer.
+
+        The offsets are the boundaries of the values, so value n is stored between offsets[n] and offsets[n + 1]. The
+        buffer is read through a memoryview, so no per-value bytes objects are created, and the decoder is reset
+        before each value.
+
+        :type buffer: bytes
+        :param buffer: The buffer containing the concatenated SCSU values.
+        :type offsets: list
+        :param offsets: A sequence of one more offset than there are values.
+        :type lazy: bool
+        :param lazy: If true, return a generator that decodes each value when it is reached.
+        :rtype: list
+        :return: A list (or generator) of the decoded Unicode strings.
+        """
+
+        # Read the buffer as unsigned octets without copying it.
+        memory_view = memoryview(buffer).cast('B')
+
+        def decode_values():
+
+            # Iterate through the boundaries of each value.
+            for value_index in range(len(offsets) - 1):
+
+                # Forget the state left by the previous value.
+                self.reset()
+
+                yield ''.join(map(chr, self.iterate_codepoints(memory_view, offsets[value_index],
+                                                               offsets[value_index + 1])))
+
+        if lazy:
+            return decode_values()
+
+        return list(decode_values())
+
+    @staticmethod
+    def compute_partial_match_table(pattern: list) -> list:
+        """
+        Compute the Knuth-Morris-Pratt partial match table for a pattern.
+
+        :type pattern: list
+        :param pattern: The pattern, as a list of Unicode codepoints.
+        :rtype: list
+        :return: For each prefix of the pattern, the length of its longest proper prefix that is also a suffix.
+        """
+        partial_match_table = [0] * len(pattern)
+        match_length = 0
+
+        # Iterate through each codepoint after the first.
+        for pattern_index in range(1, len(pattern)):
+
+            # Fall back to shorter matches until the current codepoint extends one.
+            while match_length > 0 and pattern[pattern_index] != pattern[match_length]:
+                match_length = partial_match_table[match_length - 1]
+
+            if pattern[pattern_index] == pattern[match_length]:
+                match_length += 1
+
+            partial_match_table[pattern_index] = match_length
+
+        return partial_match_table
+
+    def find_all(self, byte_array, substring: str) -> list:
+        """
+        Find every occurrence of a substring in a SCSU byte array without decoding it into a string.
+
+        Matching runs on the codepoints as they are decoded, so overlapping occurrences are all reported.
+
+        :type byte_array: bytes
+        :param byte_array: The SCSU byte array to search.
+        :type substring: str
+        :param substring: The Unicode string to search for.
+        :rtype: list
+        :return: The character offsets of each occurrence.
+        """
+        pattern = [ord(character) for character in substring]
+
+        # Forget the state left by anything decoded before.
+        self.reset()
+
+        # An empty substring matches at every character offset.
+        if not pattern:
+            return list(range(sum(1 for _ in self.iterate_codepoints(byte_array)) + 1))
+
+        partial_match_table = self.compute_partial_match_table(pattern)
+        pattern_length = len(pattern)
+
+        match_offsets = []
+        match_length = 0
+
+        # Iterate through each decoded codepoint.
+        for character_offset, codepoint in enumerate(self.iterate_codepoints(byte_array)):
+
+            # Fall back to shorter matches until the current codepoint extends one.
+            while match_length > 0 and codepoint != pattern[match_length]:
+                match_length = partial_match_table[match_length - 1]
+
+            if codepoint == pattern[match_length]:
+                match_length += 1
+
+            # Did we match the whole pattern?
+            if match_length == pattern_length:
+                match_offsets.append(character_offset - pattern_length + 1)
+                match_length = partial_match_table[match_length - 1]
+
+        return match_offsets
+
+    def startswith(self, byte_array, prefix: str) -> bool:
+        """
+        Determine if a SCSU byte array starts with a given prefix, decoding only as much as needed.
+
+        :type byte_array: bytes
+        :param byte_array: The SCSU byte array to check.
+        :type prefix: str
+        :param prefix: The Unicode string to look for.
+        :rtype: bool
+        :return: True if the decoded string starts with the prefix; false otherwise.
+        """
+        prefix_length = len(prefix)
+
+        # An empty prefix always matches.
+        if prefix_length == 0:
+            return True
+
+        # Forget the state left by anything decoded before.
+        self.reset()
+
+        # Compare each decoded codepoint until we run out of prefix or find a mismatch.
+        for character_offset, codepoint in enumerate(self.iterate_codepoints(byte_array)):
+            if codepoint != ord(prefix[character_offset]):
+                return False
+            if character_offset + 1 == prefix_length:
+                return True
+
+        return False
+
+
+class SCSUIncrementalDecoder(codecs.IncrementalDecoder):
+    """
+    Decode SCSU input that arrives in chunks of any size, following the codecs.IncrementalDecoder interface.
+
+    Only the octets of a sequence split across chunks are kept between calls. The mode, the dynamic windows and any
+    high surrogate waiting for its low surrogate are kept by the underlying SCSUDecoder.
+    """
+
+    def __init__(self, errors: str = 'strict'):
+        """
+        Instantiate an incremental SCSU decoder object.
+
+        :type errors: str
+        :param errors: The error handling scheme. Only 'strict' is supported, since there is no telling where the next
+                       sequence starts after malformed SCSU input.
+        """
+        if errors != 'strict':
+            raise ValueError('Unsupported error handling scheme: {0:s}'.format(errors))
+
+        super().__init__(errors)
+        self.decoder = SCSUDecoder()
+        self.buffer = b''
+
+    def decode(self, input, final: bool = False) -> str:
+        """
+        Decode a chunk of SCSU input.
+
+        :type input: bytes
+        :param input: The next chunk of the SCSU byte array.
+        :type final: bool
+        :param final: True if this is the last chunk.
+        :rtype: str
+        :return: The Unicode string decoded from every complete sequence so far.
+        """
+
+        # Put any octets held over from the last chunk in front of this one.
+        byte_array = self.buffer + bytes(input) if self.buffer else input
+
+        # Decode every complete sequence and hold over whatever is left.
+        unicode_string = ''.join(map(chr, self.decoder.iterate_codepoints(byte_array, final=final)))
+        self.buffer = bytes(byte_array[self.decoder.position:])
+        return unicode_string
+
+    def reset(self):
+        """
+        Reset the decoder to its initial state and discard any held over octets.
+        """
+        self.decoder.reset()
+        self.buffer = b''
+
+    def getstate(self) -> tuple:
+        """
+        Get the current state of the decoder. The decoder status is packed into an integer by
+        SCSUDecoder.get_packed_state, which is zero for the initial state.
+
+        :rtype: tuple
+        :return: A tuple containing the held over octets and the packed decoder status.
+        """
+        return self.buffer, self.decoder.get_packed_state()
+
+    def setstate(self, state: tuple):
+        """
+        Restore a state returned by getstate.
+
+        :type state: tuple
+        :param state: A tuple containing the held over octets and the packed decoder status.
+        """
+        self.buffer = bytes(state[0])
+        self.decoder.set_packed_state(state[1])
+
+
+class SCSUString:
+    """
+    An immutable Unicode string stored in its SCSU encoding, which is decoded only when needed.
+    """
+
+    __slots__ = ('encoded', 'length', 'hash_value', 'checkpoints')
+
+    # The number of characters between entries in the checkpoint index used for slicing.
+    checkpoint_interval = 64
+
+    # The number of decoded strings to keep, shared by all instances. Zero disables the cache. The lock keeps threads
+    # from changing the cache at the same time.
+    decoded_cache_size = 0
+    decoded_cache = {}
+    decoded_cache_lock = _thread.allocate_lock()
+
+    def __init__(self, unicode_string: str):
+        """
+        Instantiate a SCSU string object.
+
+        :type unicode_string: str
+        :param unicode_string: The Unicode string to store.
+        """
+
+        # A fresh encoder always produces the same bytes for the same string, so the encoded bytes can be compared
+        # directly. Attributes are set through object.__setattr__, since __setattr__ refuses to change them.
+        object.__setattr__(self, 'encoded', bytes(SCSUEncoder().encode(unicode_string)))
+
+        # Remember the length now, while the decoded string is at hand.
+        object.__setattr__(self, 'length', len(unicode_string))
+
+        # The hash is only computed the first time it is needed, and the checkpoint index is only built the first time
+        # a slice starts past the first checkpoint_interval characters, so neither takes memory until then.
+        object.__setattr__(self, 'hash_value', None)
+        object.__setattr__(self, 'checkpoints', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('SCSUString objects are immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('SCSUString objects are immutable')
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __hash__(self) -> int:
+        if self.hash_value is None:
+            object.__setattr__(self, 'hash_value', hash(str(self)))
+        return self.hash_value
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, SCSUString):
+            return self.encoded == other.encoded
+        if isinstance(other, str):
+            return self.length == len(other) and str(self) == other
+        return NotImplemented
+
+    def __str__(self) -> str:
+
+        # Is the cache disabled?
+        if self.decoded_cache_size <= 0:
+            return SCSUDecoder().decode(self.encoded)
+
+        decoded_cache = SCSUString.decoded_cache
+
+        # Is the decoded string in the cache? If so, move it to the most recently used end.
+        with SCSUString.decoded_cache_lock:
+            decoded_string = decoded_cache.pop(self.encoded, None)
+            if decoded_string is not None:
+                decoded_cache[self.encoded] = decoded_string
+                return decoded_string
+
+        # Decode the string outside the lock, so other threads aren't kept waiting.
+        decoded_string = SCSUDecoder().decode(self.encoded)
+
+        with SCSUString.decoded_cache_lock:
+
+            # Evict the least recently used strings to make room.
+            while decoded_cache and len(decoded_cache) >= self.decoded_cache_size:
+                del decoded_cache[next(iter(decoded_cache))]
+
+            decoded_cache[self.encoded] = decoded_string
+
+        return decoded_string
+
+    def __repr__(self) -> str:
+        return 'SCSUString({0!r})'.format(str(self))
+
+    def __bytes__(self) -> bytes:
+        return self.encoded
+
+    @staticmethod
+    def append_unsigned_varint(byte_array: bytearray, value: int):
+        """
+        Append an unsigned integer to a byte array, seven bits at a time with the lowest bits first. Every octet but
+        the last has its high bit set.
+
+        :type byte_array: bytearray
+        :param byte_array: The byte array to append to.
+        :type value: int
+        :param value: The unsigned integer.
+        """
+        while value >= 0x80:
+            byte_array.append((value & 0x7F) | 0x80)
+            value >>= 7
+        byte_array.append(value)
+
+    @staticmethod
+    def read_unsigned_varint(byte_array: bytes, index: int) -> tuple:
+        """
+        Read an unsigned integer written by append_unsigned_varint.
+
+        :type byte_array: bytes
+        :param byte_array: The byte array to read from.
+        :type index: int
+        :param index: The index of the first octet.
+        :rtype: tuple
+        :return: A tuple containing the unsigned integer and the index of the octet after it.
+        """
+        value = 0
+        shift = 0
+        while True:
+            octet = byte_array[index]
+            index += 1
+            value |= (octet & 0x7F) << shift
+            if octet < 0x80:
+                return value, index
+            shift += 7
+
+    def build_checkpoints(self):
+        """
+        Decode the string once, recording the decoder state after every checkpoint_interval characters.
+
+        Each checkpoint is the number of octets since the previous checkpoint, followed by the packed decoder state,
+        both written with append_unsigned_varint into one bytes object. The packed state is zero for the default
+        windows, so most checkpoints take two or three octets.
+        """
+        decoder = SCSUDecoder()
+        checkpoints = bytearray()
+        previous_position = 0
+
+        # Iterate through each decoded codepoint.
+        for character_offset, _ in enumerate(decoder.iterate_codepoints(self.encoded), 1):
+
+            # Record the position and decoder state after every checkpoint_interval characters.
+            if character_offset % self.checkpoint_interval == 0:
+                self.append_unsigned_varint(checkpoints, decoder.position - previous_position)
+                self.append_unsigned_varint(checkpoints, decoder.get_packed_state())
+                previous_position = decoder.position
+
+        object.__setattr__(self, 'checkpoints', bytes(checkpoints))
+
+    def decode_range(self, start: int, stop: int) -> str:
+        """
+        Decode the characters between two character offsets, starting from the nearest checkpoint. Slices that start
+        within the first checkpoint_interval characters are decoded from the start, without building the index.
+
+        :type start: int
+        :param start: The offset of the first character.
+        :type stop: int
+        :param stop: The offset after the last character.
+        :rtype: str
+        :return: The decoded characters.
+        """
+        if start >= stop:
+            return ''
+
+        decoder = SCSUDecoder()
+        position = 0
+
+        # Find the last checkpoint at or before the first character. The start of the string is not recorded.
+        checkpoint_index = start // self.checkpoint_interval
+        if checkpoint_index > 0:
+            if self.checkpoints is None:
+                self.build_checkpoints()
+
+            # Add up the positions of each checkpoint up to the one we want, then restore the decoder state there.
+            index = 0
+            for _ in range(checkpoint_index):
+                position_offset, index = self.read_unsigned_varint(self.checkpoints, index)
+                packed_state, index = self.read_unsigned_varint(self.checkpoints, index)
+                position += position_offset
+            decoder.set_packed_state(packed_state)
+
+        # Skip the characters between the checkpoint and the first character, then decode the rest.
+        characters = []
+        skip_count = start - checkpoint_index * self.checkpoint_interval
+        for codepoint in decoder.iterate_codepoints(self.encoded, position):
+            if skip_count > 0:
+                skip_count -= 1
+                continue
+            characters.append(chr(codepoint))
+            if len(characters) == stop - start:
+                break
+
+        return ''.join(characters)
+
+    def __getitem__(self, key) -> str:
+
+        # Is the key a slice?
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+
+            # Only contiguous slices can be decoded from a checkpoint.
+            if step != 1:
+                return str(self)[key]
+
+            return self.decode_range(start, stop)
+
+        # Support negative indices, like str.
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError('string index out of range')
+
+        return self.decode_range(key, key + 1)
+
+    def startswith(self, prefix: str) -> bool:
+        """
+        Determine if the string starts with a given prefix, decoding only as much as needed.
+
+        :type prefix: str
+        :param prefix: The Unicode string to look for.
+        :rtype: bool
+        :return: True if the string starts with the prefix; false otherwise.
+        """
+        return len(prefix) <= self.length and SCSUDecoder().startswith(self.encoded, prefix)
+
+
+class SCSUCompressedWriter:
+    """
+    Write Unicode text to a binary file as SCSU, further compressed with zlib, lzma or bz2, one chunk at a time.
+    """
+
+    def __init__(self, file_object, compression: str = 'zlib'):
+        """
+        Instantiate a compressed SCSU writer object.
+
+        :type file_object: io.RawIOBase
+        :param file_object: The binary file to write to.
+        :type compression: str
+        :param compression: The name of the compression module: 'zlib', 'lzma' or 'bz2'.
+        """
+        self.file_object = file_object
+        self.encoder = SCSUEncoder()
+        self.closed = False
+
+        # Import the compression module only when it is needed.
+        if compression == 'zlib':
+            import zlib
+            self.compressor = zlib.compressobj()
+        elif compression == 'lzma':
+            import lzma
+            self.compressor = lzma.LZMACompressor()
+        elif compression == 'bz2':
+            import bz2
+            self.compressor = bz2.BZ2Compressor()
+        else:
+            raise ValueError('Unknown compression: {0:s}'.format(compression))
+
+    def write(self, unicode_string: str):
+        """
+        Encode a chunk of Unicode text and write whatever the compressor produces.
+
+        :type unicode_string: str
+        :param unicode_string: The Unicode text to write.
+        """
+        # Writing after the compressor has been flushed would corrupt the output, as it would for a closed io object.
+        if self.closed:
+            raise ValueError('I/O operation on closed writer.')
+
+        self.file_object.write(self.compressor.compress(self.encoder.encode(unicode_string)))
+
+    def close(self):
+        """
+        Flush the compressor. The underlying file is left open. Calling this more than once has no further effect.
+        """
+        # The compressor can only be flushed once.
+        if self.closed:
+            return
+
+        self.file_object.write(self.compressor.flush())
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SCSUCompressedReader:
+    """
+    Read Unicode text from a binary file written by SCSUCompressedWriter, one chunk at a time.
+    """
+
+    def __init__(self, file_object, compression: str = 'zlib', chunk_size: int = 65536):
+        """
+        Instantiate a compressed SCSU reader object.
+
+        :type file_object: io.RawIOBase
+        :param file_object: The binary file to read from.
+        :type compression: str
+        :param compression: The name of the compression module: 'zlib', 'lzma' or 'bz2'.
+        :type chunk_size: int
+        :param chunk_size: The number of compressed octets to read at a time, which is also the most octets
+                           decompressed at a time.
+        """
+        self.file_object = file_object
+        self.chunk_size = chunk_size
+        self.decoder = SCSUIncrementalDecoder()
+
+        # Import the compression module only when it is needed.
+        if compression == 'zlib':
+            import zlib
+            self.decompressor = zlib.decompressobj()
+        elif compression == 'lzma':
+            import lzma
+            self.decompressor = lzma.LZMADecompressor()
+        elif compression == 'bz2':
+            import bz2
+            self.decompressor = bz2.BZ2Decompressor()
+        else:
+            raise ValueError('Unknown compression: {0:s}'.format(compression))
+
+    def __iter__(self):
+        """
+        Decode the file one chunk at a time.
+
+        :rtype: generator
+        :return: A generator of decoded Unicode strings.
+        """
+
+        # Iterate through each compressed chunk, decompress it and decode every complete sequence. The incremental
+        # decoder keeps the octets of any sequence split across chunks.
+        for compressed_chunk in iter(lambda: self.file_object.read(self.chunk_size), b''):
+            while True:
+
+                # Decompress at most chunk_size octets, so highly compressed input can't produce a huge chunk.
+                byte_array = self.decompressor.decompress(compressed_chunk, self.chunk_size)
+                yield self.decoder.decode(byte_array)
+
+                # zlib returns the input it didn't get to, while lzma and bz2 keep it. Either way, a full chunk of
+                # output means there may be more to come.
+                compressed_chunk = getattr(self.decompressor, 'unconsumed_tail', b'')
+                if self.decompressor.eof or (len(byte_array) < self.chunk_size and not compressed_chunk):
+                    break
+
+        # Flush the decompressor, if it needs to be, and decode whatever is left.
+        yield self.decoder.decode(self.decompressor.flush() if hasattr(self.decompressor, 'flush') else b'', final=True)
+
+    def read(self) -> str:
+        """
+        Decode the rest of the file.
+
+        :rtype: str
+        :return: The decoded Unicode string.
+        """
+        return ''.join(self)
+
+
+class SCSUSQLite:
+    """
+    Store Unicode text in SQLite as SCSU blobs.
+
+    Insert SCSUString values into columns declared as SCSUTEXT, and open connections with
+    detect_types=sqlite3.PARSE_DECLTYPES to read them back as str. The converter can't tell a SCSU blob from UTF-8
+    text, so declare columns with column_definition, which rejects anything but blobs and NULL.
+    """
+
+    DECLARED_TYPE = 'SCSUTEXT'
+
+    @staticmethod
+    def encode(unicode_string: str) -> bytes:
+        """
+        Encode a Unicode string as a SCSU blob, passing NULL through. Any other value raises TypeError, which SQLite
+        reports as an OperationalError (call sqlite3.enable_callback_tracebacks(True) to see the message).
+
+        :type unicode_string: str
+        :param unicode_string: The Unicode string to encode.
+        :rtype: bytes
+        :return: The SCSU blob.
+        """
+        if unicode_string is None:
+            return None
+        if not isinstance(unicode_string, str):
+            raise TypeError('scsu_encode expects TEXT or NULL, not {0:s}'.format(type(unicode_string).__name__))
+        return bytes(SCSUEncoder().encode(unicode_string))
+
+    @staticmethod
+    def decode(blob: bytes) -> str:
+        """
+        Decode a SCSU blob into a Unicode string, passing NULL and TEXT values through.
+
+        :type blob: bytes
+        :param blob: The SCSU blob.
+        :rtype: str
+        :return: The decoded Unicode string.
+        """
+        if blob is None or isinstance(blob, str):
+            return blob
+        return SCSUDecoder().decode(blob)
+
+    @staticmethod
+    def length(blob: bytes) -> int:
+        """
+        Count the characters in a SCSU blob without building the decoded string, passing NULL through. TEXT values
+        are counted as they are.
+
+        :type blob: bytes
+        :param blob: The SCSU blob.
+        :rtype: int
+        :return: The number of characters.
+        """
+        if blob is None:
+            return None
+        if isinstance(blob, str):
+            return len(blob)
+        return sum(1 for _ in SCSUDecoder().iterate_codepoints(blob))
+
+    @staticmethod
+    def column_definition(column_name: str) -> str:
+        """
+        Build the definition of a SCSUTEXT column for a CREATE TABLE statement. A CHECK constraint makes SQLite
+        reject values that aren't blobs or NULL, such as a str inserted without going through SCSUString or
+        scsu_encode, which the converter would otherwise decode into the wrong text.
+
+        :type column_name: str
+        :param column_name: The name of the column, which is quoted as an identifier.
+        :rtype: str
+        :return: The column definition.
+        """
+
+        # Quote the column name, doubling any quotes in it, so it can't change the meaning of the statement.
+        quoted_column_name = '"' + column_name.replace('"', '""') + '"'
+
+        return "{0:s} {1:s} CHECK (typeof({0:s}) IN ('blob', 'null'))".format(
+            quoted_column_name, SCSUSQLite.DECLARED_TYPE)
+
+    @staticmethod
+    def register_adapters():
+        """
+        Register an adapter that stores SCSUString values as blobs, and a converter that decodes SCSUTEXT columns.
+        """
+        import sqlite3
+        sqlite3.register_adapter(SCSUString, bytes)
+        sqlite3.register_converter(SCSUSQLite.DECLARED_TYPE, SCSUSQLite.decode)
+
+    @staticmethod
+    def register_functions(connection):
+        """
+        Register the scsu_encode, scsu_decode and scsu_length SQL functions on a connection.
+
+        :type connection: sqlite3.Connection
+        :param connection: The database connection.
+        """
+        connection.create_function('scsu_encode', 1, SCSUSQLite.encode, deterministic=True)
+        connection.create_function('scsu_decode', 1, SCSUSQLite.decode, deterministic=True)
+        connection.create_function('scsu_length', 1, SCSUSQLite.length, deterministic=True)
@@ -1,7 +1,18 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from scsu import SCSUEncoder
+import io
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+from scsu import SCSUEncoder, SCSUDecoder, SCSUIncrementalDecoder, SCSUString, SCSUCompressedWriter, \
+    SCSUCompressedReader, SCSUSQLite
 
 
 def test_encodings(language: str, text: str):
@@ -13,6 +24,324 @@ def test_encodings(language: str, text: str):
     e.train(text)
     b = e.encode(text)
     print('\tIN {0:s}: {1:d} byte(s)'.format('SCSU', len(b)))
+    assert SCSUDecoder().decode(b) == text
+    state = e.save_state()
+    b = e.encode_adaptive(text)
+    print('\tIN {0:s}: {1:d} byte(s)'.format('ADAPTIVE', len(b)))
+    assert SCSUDecoder().decode_adaptive(b) == text
+    # The encoder's own state must be left as it was.
+    assert e.save_state() == state
+    print('')
+
+
+def test_decode_many(texts: list):
+    e = SCSUEncoder()
+    buffer = bytearray()
+    offsets = [0]
+    for text in texts:
+        e.reset()
+        buffer += e.encode(text)
+        offsets.append(len(buffer))
+    d = SCSUDecoder()
+    assert d.decode_many(buffer, offsets) == texts
+    assert list(d.decode_many(buffer, offsets, lazy=True)) == texts
+
+    # An error must carry only the malformed value, with positions relative to it, not the whole buffer.
+    truncated_value = b'A\x0f\x4e'
+    try:
+        d.decode_many(buffer + truncated_value + buffer, offsets + [len(buffer) + 3, len(buffer) * 2 + 3])
+        assert False
+    except UnicodeDecodeError as error:
+        assert error.object == truncated_value
+        assert (error.start, error.end) == (2, 3)
+    print('\t{0:d} value(s) in {1:d} byte(s)'.format(len(texts), len(buffer)))
+    print('')
+
+
+def test_incremental(language: str, text: str):
+    print('{0:s} LANGUAGE TEXT:'.format(language.upper()))
+    b = bytes(SCSUEncoder().encode(text))
+    for chunk_size in (1, 2, 3, 7):
+        d = SCSUIncrementalDecoder()
+        decoded_text = ''
+        for index in range(0, len(b), chunk_size):
+            decoded_text += d.decode(b[index:index + chunk_size])
+
+            # Carry on decoding with a new decoder restored from the state of the old one.
+            state = d.getstate()
+            d = SCSUIncrementalDecoder()
+            d.setstate(state)
+        decoded_text += d.decode(b'', final=True)
+        assert decoded_text == text
+    try:
+        SCSUIncrementalDecoder('replace')
+        assert False, 'an unsupported error handling scheme was accepted'
+    except ValueError:
+        pass
+    print('\t{0:d} byte(s) decoded in chunks of 1, 2, 3 and 7 byte(s)'.format(len(b)))
+    print('')
+
+
+def find_all_in_string(text: str, substring: str) -> list:
+    offsets = []
+    offset = text.find(substring)
+    while offset != -1:
+        offsets.append(offset)
+        offset = text.find(substring, offset + 1)
+    return offsets
+
+
+def test_search(language: str, text: str, substring: str, repeat: int = 20):
+    print('{0:s} LANGUAGE TEXT, SEARCHING FOR {1:s}:'.format(language.upper(), substring))
+    e = SCSUEncoder()
+    b = e.encode(text * repeat)
+    start = time.perf_counter()
+    offsets = SCSUDecoder().find_all(b, substring)
+    search_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    expected_offsets = find_all_in_string(SCSUDecoder().decode(b), substring)
+    decode_seconds = time.perf_counter() - start
+    assert offsets == expected_offsets
+
+    # Searching with a decoder left in Unicode mode by an earlier string must give the same answer.
+    d = SCSUDecoder()
+    d.decode(SCSUEncoder().encode('統一碼'))
+    assert d.find_all(b, substring) == expected_offsets and d.startswith(b, text[:5])
+    print('\t{0:d} match(es) in {1:d} byte(s)'.format(len(offsets), len(b)))
+    print('\tFIND_ALL: {0:.2f} MB/s'.format(len(b) / search_seconds / 1e6))
+    print('\tDECODE THEN FIND: {0:.2f} MB/s'.format(len(b) / decode_seconds / 1e6))
+    print('')
+
+
+def get_scsu_string_size(s: SCSUString) -> int:
+    # Count the object and everything it holds on to. Integers up to 256 are shared, so they aren't counted.
+    size = sys.getsizeof(s) + sys.getsizeof(s.encoded)
+    for value in (s.length, s.hash_value, s.checkpoints):
+        if value is not None and not (isinstance(value, int) and value <= 256):
+            size += sys.getsizeof(value)
+    return size
+
+
+def test_string(language: str, text: str, smaller: bool = False):
+    print('{0:s} LANGUAGE TEXT:'.format(language.upper()))
+    s = SCSUString(text)
+    size = get_scsu_string_size(s)
+
+    # Slice the end of the string, which builds the checkpoint index for strings longer than checkpoint_interval.
+    assert s[5:25] == text[5:25] and s[-20:] == text[-20:] and s.startswith(text[:5])
+    sliced_size = get_scsu_string_size(s)
+    print('\tAS str: {0:d} byte(s)'.format(sys.getsizeof(text)))
+    print('\tAS SCSUString: {0:d} byte(s), {1:d} byte(s) after slicing'.format(size, sliced_size))
+    if smaller:
+        assert size < sys.getsizeof(text) and sliced_size < sys.getsizeof(text)
+    assert s == text and hash(s) == hash(text) and len(s) == len(text)
+    try:
+        s.encoded = b''
+        assert False, 'a SCSUString was changed'
+    except AttributeError:
+        pass
+    print('')
+
+
+def test_string_cache(texts: list, cache_size: int = 4, thread_count: int = 8):
+    print('{0:d} STRING(S), CACHE SIZE {1:d}, {2:d} THREAD(S):'.format(len(texts), cache_size, thread_count))
+    strings = [SCSUString(text) for text in texts]
+    errors = []
+
+    def decode_strings():
+        try:
+            for index in range(2000):
+                assert str(strings[index % len(strings)]) == texts[index % len(texts)]
+        except Exception as e:
+            errors.append(e)
+
+    SCSUString.decoded_cache_size = cache_size
+    threads = [threading.Thread(target=decode_strings) for _ in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    SCSUString.decoded_cache_size = 0
+    assert not errors and len(SCSUString.decoded_cache) <= cache_size
+    print('\t{0:d} string(s) cached'.format(len(SCSUString.decoded_cache)))
+    SCSUString.decoded_cache.clear()
+    print('')
+
+
+def compress_with_scsu(text: str, compression: str = None) -> bytes:
+    if compression is None:
+        return bytes(SCSUEncoder().encode(text))
+    f = io.BytesIO()
+    with SCSUCompressedWriter(f, compression) as w:
+        for index in range(0, len(text), 4096):
+            w.write(text[index:index + 4096])
+    return f.getvalue()
+
+
+def generate_corpus(text: str, length: int = 20000, seed: int = 0) -> str:
+    # Draw words from the sentence at random (characters, for scripts written without spaces), so that the corpus
+    # has the vocabulary of the language without being one sentence over and over.
+    words = text.split()
+    separator = ' '
+    if len(words) < 4:
+        words = [character for character in text if not character.isspace()]
+        separator = ''
+    generator = random.Random(seed)
+    corpus = []
+    corpus_length = 0
+    while corpus_length < length:
+        word = generator.choice(words)
+        corpus.append(word)
+        corpus_length += len(word) + len(separator)
+    return separator.join(corpus)
+
+
+def test_compression(language: str, text: str):
+    text = generate_corpus(text)
+    print('{0:s} LANGUAGE TEXT, {1:d} CHARACTER(S) OF SHUFFLED WORDS:'.format(language.upper(), len(text)))
+    utf8_length = len(text.encode('UTF-8'))
+    for method, compress in (('SCSU', lambda: compress_with_scsu(text)),
+                             ('ZLIB', lambda: zlib.compress(text.encode('UTF-8'))),
+                             ('SCSU+ZLIB', lambda: compress_with_scsu(text, 'zlib')),
+                             ('SCSU+LZMA', lambda: compress_with_scsu(text, 'lzma'))):
+        start = time.perf_counter()
+        compressed_length = len(compress())
+        seconds = time.perf_counter() - start
+        print('\tIN {0:s}: {1:d} byte(s), {2:.3f} of UTF-8, {3:.2f} MB/s'.format(
+            method, compressed_length, compressed_length / utf8_length, utf8_length / seconds / 1e6))
+    for compression in ('zlib', 'lzma', 'bz2'):
+        f = io.BytesIO(compress_with_scsu(text, compression))
+        assert SCSUCompressedReader(f, compression, chunk_size=100).read() == text
+    print('')
+
+
+def test_compression_close(text: str):
+    # Closing explicitly inside a with block must not flush the compressor a second time.
+    for compression in ('zlib', 'lzma', 'bz2'):
+        f = io.BytesIO()
+        with SCSUCompressedWriter(f, compression) as writer:
+            writer.write(text)
+            writer.close()
+            writer.close()
+        try:
+            writer.write(text)
+            assert False
+        except ValueError:
+            pass
+        f.seek(0)
+        assert SCSUCompressedReader(f, compression).read() == text
+
+
+def test_compression_chunk_size(text: str, chunk_size: int = 4096):
+    print('{0:d} CHARACTER(S), CHUNK SIZE {1:d}:'.format(len(text), chunk_size))
+    for compression in ('zlib', 'lzma', 'bz2'):
+        f = io.BytesIO(compress_with_scsu(text, compression))
+        compressed_length = len(f.getvalue())
+        chunks = list(SCSUCompressedReader(f, compression, chunk_size=chunk_size))
+        assert ''.join(chunks) == text
+        assert max(len(chunk) for chunk in chunks) <= chunk_size
+        print('\tIN {0:s}: {1:d} byte(s), longest chunk {2:d} character(s)'.format(
+            compression.upper(), compressed_length, max(len(chunk) for chunk in chunks)))
+    print('')
+
+
+def test_sqlite(texts: list, row_count: int):
+    print('{0:d} ROW(S):'.format(row_count))
+    SCSUSQLite.register_adapters()
+    like_counts = []
+    for column_type, wrap, body in (('TEXT', str, 'body'), ('SCSUTEXT', SCSUString, 'scsu_decode(body)')):
+        c = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES)
+        SCSUSQLite.register_functions(c)
+        if column_type == 'TEXT':
+            c.execute('CREATE TABLE t (body TEXT)')
+        else:
+            c.execute('CREATE TABLE t ({0:s})'.format(SCSUSQLite.column_definition('body')))
+            try:
+                c.execute('INSERT INTO t VALUES (?)', (texts[0],))
+                assert False, 'a str was stored in a SCSUTEXT column'
+            except sqlite3.IntegrityError:
+                pass
+            for value in (1, b'A'):
+                try:
+                    c.execute('SELECT scsu_encode(?)', (value,))
+                    assert False, 'scsu_encode accepted a value that is not TEXT'
+                except sqlite3.OperationalError:
+                    pass
+        start = time.perf_counter()
+        c.executemany('INSERT INTO t VALUES (?)', ((wrap(texts[index % len(texts)]),) for index in range(row_count)))
+        insert_seconds = time.perf_counter() - start
+        size = c.execute('PRAGMA page_count').fetchone()[0] * c.execute('PRAGMA page_size').fetchone()[0]
+        start = time.perf_counter()
+        rows = c.execute('SELECT body FROM t').fetchall()
+        select_seconds = time.perf_counter() - start
+        assert [row[0] for row in rows] == [texts[index % len(texts)] for index in range(row_count)]
+        start = time.perf_counter()
+        like_counts.append(c.execute("SELECT count(*) FROM t WHERE {0:s} LIKE '%Unicode%'".format(body)).fetchone()[0])
+        like_seconds = time.perf_counter() - start
+        print('\tAS {0:s}: {1:d} byte(s), insert {2:.2f} s, select {3:.2f} s, like {4:.2f} s'.format(
+            column_type, size, insert_seconds, select_seconds, like_seconds))
+        c.close()
+    assert like_counts[0] == like_counts[1]
+
+    # Column names are quoted, so any name can be used.
+    c = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES)
+    c.execute('CREATE TABLE t ({0:s})'.format(SCSUSQLite.column_definition('select "body"')))
+    c.execute('INSERT INTO t VALUES (?)', (SCSUString(texts[0]),))
+    assert c.execute('SELECT "select ""body""" FROM t').fetchone()[0] == texts[0]
+    c.close()
+    print('')
+
+
+def test_lookahead(texts: list):
+    print('{0:d} MIXED-SCRIPT SENTENCE(S):'.format(len(texts)))
+    default_lengths = [len(SCSUEncoder().encode(text)) for text in texts]
+    for lookahead in (None, 2, 4, 8, 16):
+        start = time.perf_counter()
+        length = 0
+        for text, default_length in zip(texts, default_lengths):
+            b = SCSUEncoder(lookahead).encode(text)
+            assert SCSUDecoder().decode(b) == text
+            assert len(b) <= default_length
+            length += len(b)
+        print('\tLOOKAHEAD {0:s}: {1:d} byte(s), {2:.3f} s'.format(
+            str(lookahead), length, time.perf_counter() - start))
+    print('')
+
+
+def test_prefetch(texts: list, repeat: int = 20):
+    text = ' '.join(texts) * repeat
+    print('{0:d} SENTENCE(S), REPEATED {1:d} TIME(S):'.format(len(texts), repeat))
+    e = SCSUEncoder()
+    default_length = len(e.encode(text))
+    print('\tIN SCSU: {0:d} byte(s)'.format(default_length))
+    e = SCSUEncoder()
+    e.train(text)
+    print('\tIN SCSU, TRAINED: {0:d} byte(s)'.format(len(e.encode(text))))
+    e = SCSUEncoder()
+    e.prefetch_windows(text)
+    b = e.encode(text)
+    assert SCSUDecoder().decode(b) == text
+    assert len(b) <= default_length
+    print('\tIN SCSU, PREFETCHED: {0:d} byte(s)'.format(len(b)))
+    print('')
+
+
+def test_import_time(budget_microseconds: int = 50000, repeat: int = 5):
+    # Throw away the first run, which warms the file system cache. The budget allows for compiling the module, since
+    # bytecode isn't cached when PYTHONDONTWRITEBYTECODE is set.
+    command = [sys.executable, '-X', 'importtime', '-c',
+               'import sys, scsu; print(",".join(name for name in ("sqlite3", "zlib", "lzma", "bz2", "array") '
+               'if name in sys.modules))']
+    import_microseconds = []
+    for index in range(repeat + 1):
+        result = subprocess.run(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        assert result.stdout.strip() == '', 'import scsu also imported ' + result.stdout.strip()
+        line = next(line for line in result.stderr.splitlines() if line.split('|')[-1].strip() == 'scsu')
+        import_microseconds.append(int(line.split('|')[1]))
+    best_microseconds = min(import_microseconds[1:])
+    print('\tIMPORT scsu: {0:d} us (budget {1:d} us)'.format(best_microseconds, budget_microseconds))
+    assert best_microseconds < budget_microseconds
     print('')
 
 
@@ -38,8 +367,89 @@ example_sentences = [
                 'ਕੋਈ ਵੀ ਭਾਸ਼ਾ ਹੋਵੇ।')
 ]
 
+# Define a list of sentences mixing CJK text with Latin letters, digits and punctuation.
+mixed_sentences = [
+    '第1章 2023年5月，Python 3.11 版本發布。下載次數超過100萬次。',
+    '東京都の人口は約1400万人（2020年）で、GDPは1.9兆ドル。',
+    '价格：¥1,299。型号：RTX-4090，显存24GB。发布日期：2022年10月12日。',
+    '統一碼（Unicode）是電腦科學領域裡的一項業界標準，包括字元集、編碼方案等。Unicode 15.0 收錄了149,186個字元。',
+    '在2021年，我们使用了 Linux、macOS 和 Windows 10 三种操作系统进行测试，共运行了 3 轮。'
+]
+
+# Define a list of sentences in scripts without a default dynamic window.
+other_script_sentences = [
+    'ยูนิโคดเป็นมาตรฐานอุตสาหกรรมที่ช่วยให้คอมพิวเตอร์แสดงผลและจัดการข้อความได้',
+    'იუნიკოდი არის სიმბოლოების კოდირების სტანდარტი',
+    'ዩኒኮድ የኮምፒውተር ጽሑፍ መስፈርት ነው',
+    'Το Unicode είναι ένα πρότυπο κωδικοποίησης χαρακτήρων',
+    'Յունիկոդը նիշերի կոդավորման ստանդարտ է',
+    'יוניקוד הוא תקן לקידוד תווים'
+]
+
+print('IMPORT TESTS')
+print('')
+
+test_import_time()
+
 print('ENCODING TESTS')
 print('')
 
 for language, text in example_sentences:
     test_encodings(language, text)
+
+print('DECODE MANY TESTS')
+print('')
+
+test_decode_many([text for language, text in example_sentences])
+
+print('INCREMENTAL DECODING TESTS')
+print('')
+
+for language, text in example_sentences:
+    test_incremental(language, text)
+test_incremental('Emoji', '\U0001F600 SCSU \U0001F680\U0001F30D 統一碼\U0001F600')
+
+print('SEARCH TESTS')
+print('')
+
+test_search('Hindi', example_sentences[3][1], 'कोई')
+test_search('Russian', example_sentences[7][1], 'символов')
+test_search('Japanese', example_sentences[8][1], '文字')
+
+print('STRING TESTS')
+print('')
+
+# SCSUString should take less memory than str for scripts that need two bytes per character in a str.
+for language, text in example_sentences:
+    test_string(language, text, language in ('Hindi', 'Arabic', 'Bengali', 'Russian', 'Punjabi'))
+test_string_cache([text for language, text in example_sentences])
+
+print('COMPRESSION TESTS')
+print('')
+
+for language, text in example_sentences:
+    test_compression(language, text)
+test_compression_close(example_sentences[0][1])
+
+# Highly compressible text must still be decompressed a bounded chunk at a time.
+test_compression_chunk_size('a' * 300000 + 'Юникод' * 20000)
+
+print('PREFETCH TESTS')
+print('')
+
+test_prefetch([text for language, text in example_sentences] + other_script_sentences)
+
+# Single-script documents never redefine a window mid-stream, so prefetching must not make them bigger.
+for text in other_script_sentences:
+    test_prefetch([text], 100)
+
+print('LOOKAHEAD TESTS')
+print('')
+
+test_lookahead(mixed_sentences + ['é11統統，ж，'])
+
+print('SQLITE TESTS')
+print('')
+
+# Pass a row count on the command line to benchmark a bigger table, e.g. 1000000.
+test_sqlite([text for language, text in example_sentences], int(sys.argv[1]) if len(sys.argv) > 1 else 10000)